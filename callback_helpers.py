@@ -1,78 +1,67 @@
-import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from datetime import datetime, timedelta
+from struct import Struct, error as StructError
 
 from typing import Dict, Any, Optional
 
 
-# Callback data dict keys are converted to UPPERCASE abbreviations; values are converted to lowercase
-callback_data_contractions = {'type': 'T',
-                              'operator_ids': 'OIS', 'conversation_end_moment': 'CEM', 'mood': 'M',
-                              'conversation_rate': 'cr', 'better': 'b', 'same': 's', 'worse': 'w',
-                              'client_id': 'CID', 'conversation_acceptation': 'ca'}
+# Callback data is packed into a compact binary structure encoded with urlsafe base64, as Telegram limits callback data
+# to 64 bytes. The structure starts with a header of the format version and the callback type tag, which is followed by
+# the fields specific to the callback type. The version must be changed whenever the format changes, so that the data of
+# the buttons sent before the change is not misinterpreted
+callback_data_version = 1
+callback_data_header = Struct('<BB')
 
+# Callback types in the order of their tags. Each type is described with its name, the `struct` format of its fields
+# (packed right after the header) and the names of the fields
+callback_data_layouts = (
+    ('conversation_rate', Struct('<BBqIIB'),
+     ('operator_tg_id', 'operator_local_id', 'conversation_end_moment', 'mood')),
+    ('conversation_acceptation', Struct('<BBq'), ('client_id',)),
+)
+callback_data_type_tags = {name: tag for tag, (name, _, _) in enumerate(callback_data_layouts)}
 
-def contract_callback_data(d: Dict[Any, Any], converter: Optional[Dict[Any, Any]] = None) -> Dict[Any, Any]:
-    """
-    Accepts a callback data dictionary and replaces its keys and values with their aliases from `converter`
-
-    For each `x` which is a key or a value of `d`, if `x in converter.keys()`, `x` is replaced with `converter[x]` in
-    the resulting dictionary, otherwise it remains unchanged
-
-    :param d: Callback data to be contracted
-    :param converter: (default `None`) Dictionary with replacements (keys of `converter` found in `d` are replaced with
-        the corresponding values). If `None`, `callback_data_contractions` global variable is used
-    :return: `d` dictionary with keys and values contracted with `converter`
-    """
-    if converter is None:
-        converter = callback_data_contractions
-
-    e = {}
-    for key, value_ in d.items():
-        try:
-            value = converter.get(value_, value_)
-        except TypeError:  # If `value_` is not hashable, it can't be a key of `converter`
-            value = value_
+# Fields whose values are not integers. They are packed as indices of their values in the corresponding tuples
+callback_data_enums = {'mood': (None, 'better', 'same', 'worse')}
 
-        e[converter.get(key, key)] = value
-
-    return e
-
-def contract_callback_data_and_jdump(d: Dict[Any, Any], converter: Optional[Dict[Any, Any]] = None) -> str:
-    """
-    Calls `contract_callback_data` with the given arguments and `json.dumps` the result
-
-    :param d: Callback data to be contracted with `contract_callback_data`
-    :param converter: Converter to be used in `contract_callback_data`
-    :return: Dictionary returned by `contract_callback_data` and dumped with json (`json.dumps` is called with an extra
-        argument `separators=(',', ':')`)
-    """
-    return json.dumps(contract_callback_data(d, converter), separators=(',', ':'))
 
-def decontract_callback_data(d: Dict[Any, Any], converter: Optional[Dict[Any, Any]] = None) -> Dict[Any, Any]:
+def pack_callback_data(d: Dict[str, Any]) -> str:
     """
-    The synonym for `contract_callback_data` with an exception that the `converter` parameter defaults to the reversed
-    `callback_data_contractions` dictionary, not to the original one
+    Packs a callback data dictionary into a string to be sent as a button's `callback_data`
 
-    :param d: Callback data to be decontracted
-    :param converter: (default `None`) Dictionary with replacements to be forwarded to `contract_callback_data`. If
-        `None`, the <b>reversed</b> `callback_data_contractions` is used
-    :return: `d` dictionary with keys and values decontracted with `converter`
+    :param d: Callback data to be packed. Must contain the `'type'` key with one of the callback types from
+        `callback_data_layouts` and all the fields of that type (except for the fields from `callback_data_enums`,
+        which default to `None`)
+    :return: `d` packed into a binary structure and encoded with urlsafe base64
     """
-    if converter is None:
-        # Use inverted `callback_data_contractions` by default
-        converter = {v: k for k, v in callback_data_contractions.items()}
-    return contract_callback_data(d, converter)
+    tag = callback_data_type_tags[d['type']]
+    _, structure, fields = callback_data_layouts[tag]
+    values = (callback_data_enums[field].index(d.get(field)) if field in callback_data_enums else d[field]
+              for field in fields)
+    return urlsafe_b64encode(structure.pack(callback_data_version, tag, *values)).decode()
 
-def jload_and_decontract_callback_data(d: str, converter: Optional[Dict[Any, Any]] = None) -> Dict[Any, Any]:
+def unpack_callback_data(s: str) -> Optional[Dict[str, Any]]:
     """
-    The synonym for `decontract_callback_data(json.loads(d), converter)`
+    The inverse of `pack_callback_data`
 
-    :param d: Callback data to be decontracted
-    :param converter: (default `None`) Dictionary with replacements to be forwarded to `decontract_callback_data`.
-        If `None`, the value is forwarded as is (`decontract_callback_data(<...>, None)` is called)
-    :return: `d` dictionary with keys and values decontracted with `converter`
+    :param s: Callback data received from Telegram
+    :return: Callback data dictionary (with the `'type'` key and the fields of that type), or `None` if `s` is not a
+        valid callback data of the current version
     """
-    return decontract_callback_data(json.loads(d), converter)
+    try:
+        data = urlsafe_b64decode(s)
+        version, tag = callback_data_header.unpack_from(data)
+        if version != callback_data_version:
+            return None
+        name, structure, fields = callback_data_layouts[tag]
+        _, _, *values = structure.unpack(data)
+
+        d = {'type': name}
+        for field, value in zip(fields, values):
+            d[field] = callback_data_enums[field][value] if field in callback_data_enums else value
+        return d
+    except (ValueError, StructError, IndexError):  # `binascii.Error` raised for invalid base64 is a `ValueError`
+        return None
 
 
 # Used to reduce number of digits in the `total_seconds` sent as a callback
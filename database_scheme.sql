@@ -10,6 +10,13 @@ CREATE TABLE users
     is_admin    BOOLEAN NOT NULL DEFAULT FALSE
 );
 
+/*
+ Operators and admins are a small fraction of all users, so looking them up (e.g. for inviting free operators to a
+ conversation or notifying admins) should not require scanning the whole `users` table
+ */
+CREATE INDEX users_operators_idx ON users (tg_id) WHERE is_operator;
+CREATE INDEX users_admins_idx ON users (tg_id) WHERE is_admin;
+
 CREATE TABLE conversations
 (
     client_id   integer NOT NULL UNIQUE REFERENCES users,
@@ -24,6 +31,11 @@ CREATE TABLE reflected_messages
     receiver_message_id integer NOT NULL
 );
 
+-- Used for finding the original of a message which is being replied to. `sender_message_id` is included for the lookup
+-- to be an index-only scan
+CREATE INDEX reflected_messages_lookup_idx ON reflected_messages (receiver_chat_id, receiver_message_id, sender_chat_id)
+    INCLUDE (sender_message_id);
+
 
 CREATE FUNCTION user_is_operator(integer) RETURNS boolean
 AS
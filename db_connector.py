@@ -1,18 +1,99 @@
+from atexit import register as atexit_register
 from contextlib import contextmanager
+from time import monotonic
+from typing import NamedTuple
 
-from psycopg2 import connect
-from psycopg2.extensions import cursor as cursor_type
+from psycopg2 import OperationalError, InterfaceError
+from psycopg2.extensions import connection as connection_type, cursor as cursor_type
+from psycopg2.pool import ThreadedConnectionPool
 
 from config import db_host, db_name, db_username, db_password
 
 
+class PreparedStatement(NamedTuple):
+    """
+    Statement which is prepared on every connection of the pool. It is run as `EXECUTE <name>(<arguments>)`
+    """
+    name: str
+    query: str  # With `$1`, `$2`, ... placeholders
+
+
+# Statements which are run on the hottest paths of the bot are prepared once per connection, so that they are not parsed
+# and planned again on each execution
+reflected_message_lookup = PreparedStatement(
+    'reflected_message_lookup',
+    "SELECT sender_message_id FROM reflected_messages WHERE sender_chat_id=$1 AND receiver_chat_id=$2 AND "
+    "receiver_message_id=$3"
+)
+prepared_statements = (reflected_message_lookup,)
+
+
+class PreparingConnection(connection_type):
+    """
+    Connection which prepares all the `prepared_statements` as soon as it is established. It also keeps the moment (by
+    `time.monotonic`) when it was last returned to the pool in the `last_used` attribute
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_used = monotonic()
+        try:
+            with self.cursor() as cursor:
+                for statement in prepared_statements:
+                    cursor.execute(f"PREPARE {statement.name} AS {statement.query}")
+            self.commit()
+        except Exception:
+            self.close()
+            raise
+
+
+# Connections are reused between `PrettyCursor`s instead of being opened for each of them, because establishing a new
+# connection is much more expensive than running a typical query of the bot
+connection_pool = ThreadedConnectionPool(minconn=2, maxconn=20, connection_factory=PreparingConnection,
+                                         host=db_host, dbname=db_name, user=db_username, password=db_password)
+atexit_register(connection_pool.closeall)
+
+# Pooled connections which have been idle for longer than this number of seconds are checked to be alive before being
+# used, as the server might have closed them in the meantime (e.g. because of a restart or an idle session timeout)
+connection_max_unchecked_idle_time = 30
+
+
+def get_connection() -> PreparingConnection:
+    """
+    Takes a working connection from `connection_pool`
+
+    Connections which are known to be closed or which fail the liveness check are closed and replaced with other ones
+
+    :return: Connection which must be returned to `connection_pool` after use
+    """
+    while True:
+        conn = connection_pool.getconn()
+        if not conn.closed:
+            if monotonic() - conn.last_used < connection_max_unchecked_idle_time:
+                return conn
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                conn.rollback()
+            except (OperationalError, InterfaceError):
+                pass
+            else:
+                return conn
+        connection_pool.putconn(conn, close=True)
+
+
 @contextmanager
 def PrettyCursor() -> cursor_type:
-    conn = connect(host=db_host, dbname=db_name, user=db_username, password=db_password)
-    cursor = conn.cursor()
+    conn = get_connection()
     try:
-        yield cursor
+        cursor = conn.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+            # If the connection has been lost, committing would raise an exception hiding the original one
+            if not conn.closed:
+                conn.commit()
     finally:
-        cursor.close()
-        conn.commit()
-        conn.close()
+        conn.last_used = monotonic()
+        # A broken connection must not be given to anybody else
+        connection_pool.putconn(conn, close=bool(conn.closed))
@@ -1,12 +1,38 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
 import psycopg2.errors
 from typing import Tuple, List, Union
 
 from db_connector import PrettyCursor
 
 
+# `conversing_cache` is a process-local LRU cache of `get_conversing` results (an ordered dictionary from telegram id to
+# the value returned by `get_conversing` for it, the least recently used entries first), which holds at most
+# `conversing_cache_size` entries. Conversations are only changed by `begin_conversation` and `end_conversation`, which
+# remove the entries of both participants from the cache after committing, so that they are re-read from the database.
+# `conversing_cache_version` is incremented on every such removal, so that `get_conversing` doesn't store a result which
+# it had fetched from the database before the change
+conversing_cache = OrderedDict()
+conversing_cache_size = 10_000
+conversing_cache_version = 0
+# `conversing_cache_lock` is a lock which must be acquired when working with `conversing_cache` and its version
+conversing_cache_lock = Lock()
+
+
+# `known_users` is a set of telegram ids of users which are known to be in the database already. Users are never
+# deleted, so `add_user` doesn't need to query the database for them again
+known_users = set()
+
+
 def add_user(tg_id: int) -> None:
+    if tg_id in known_users:
+        return
+
     with PrettyCursor() as cursor:
         cursor.execute("INSERT INTO users(tg_id) VALUES (%s) ON CONFLICT DO NOTHING", (tg_id,))
+    known_users.add(tg_id)
 
 def get_local_id(tg_id: int) -> int:
     """
@@ -26,8 +52,10 @@ def get_free_operators() -> List[int]:
     :return: `list` of telegram ids of free operators
     """
     with PrettyCursor() as cursor:
-        cursor.execute("SELECT tg_id FROM users WHERE is_operator AND NOT "
-                       "(operator_is_crying(tg_id) OR operator_is_operating(tg_id))")
+        cursor.execute("SELECT u.tg_id FROM users u "
+                       "LEFT JOIN conversations c1 ON c1.client_id=u.tg_id "
+                       "LEFT JOIN conversations c2 ON c2.operator_id=u.tg_id "
+                       "WHERE u.is_operator AND c1.client_id IS NULL AND c2.operator_id IS NULL")
         return [i[0] for i in cursor.fetchall()]
 
 
@@ -46,39 +74,83 @@ def get_conversing(tg_id: int) -> Union[Tuple[Tuple[int, int], Tuple[int, int]],
         and each of them consists of two `int`s, the first of which is the telegram id of a person, the second is the
         local id
     """
+    with conversing_cache_lock:
+        if tg_id in conversing_cache.keys():
+            conversing_cache.move_to_end(tg_id)
+            return conversing_cache[tg_id]
+        version = conversing_cache_version
+
     with PrettyCursor() as cursor:
-        cursor.execute("SELECT client_id,   (SELECT local_id FROM users WHERE tg_id=client_id), "
-                       "       operator_id, (SELECT local_id FROM users WHERE tg_id=operator_id) "
-                       "FROM conversations WHERE client_id=%s OR operator_id=%s",
+        # The `OR` of the two conditions is split into a `UNION ALL` of two lookups, so that each of them is guaranteed
+        # to use the index on the corresponding `UNIQUE` column
+        cursor.execute("SELECT c.client_id, uc.local_id, c.operator_id, uo.local_id FROM "
+                       "(SELECT client_id, operator_id FROM conversations WHERE client_id=%s "
+                       " UNION ALL "
+                       " SELECT client_id, operator_id FROM conversations WHERE operator_id=%s LIMIT 1) c "
+                       "LEFT JOIN users uc ON uc.tg_id=c.client_id LEFT JOIN users uo ON uo.tg_id=c.operator_id",
                        (tg_id, tg_id))
         try:
             a, b, c, d = cursor.fetchone()
         except TypeError:
-            return (None, None), (None, None)
-        return (a, b), (c, d)
+            conversing = (None, None), (None, None)
+        else:
+            conversing = (a, b), (c, d)
+
+    with conversing_cache_lock:
+        if version == conversing_cache_version:
+            conversing_cache[tg_id] = conversing
+            if len(conversing_cache) > conversing_cache_size:
+                conversing_cache.popitem(last=False)
+
+    return conversing
+
+
+def invalidate_conversing_cache(*tg_ids: int) -> None:
+    """
+    Removes the cached `get_conversing` results for the given users. Must be called after a change of their
+    conversations is committed
+
+    The cache is only invalidated rather than updated with the new values, because concurrent changes are not ordered
+    with each other, so the value written last may be outdated
+
+    :param tg_ids: Telegram identifiers of the users whose conversations have changed
+    """
+    global conversing_cache_version
+    with conversing_cache_lock:
+        conversing_cache_version += 1
+        for tg_id in tg_ids:
+            conversing_cache.pop(tg_id, None)
 
 
-def begin_conversation(tg_client_id: int, tg_operator_id: int) -> bool:
+def begin_conversation(tg_client_id: int, tg_operator_id: int) -> Union[Tuple[int, int], Tuple[None, None]]:
     """
     Begins a conversation between a client and an operator
 
     :param tg_client_id: Telegram id of the client to start conversation with
     :param tg_operator_id: Telegram id of the operator to start conversation with
-    :return: `True` if the conversation was started successfully, `False` otherwise (<b>for example</b>, if either the
-        client or the operator is busy). Formally, `False` is returned if the `psycopg2.errors.IntegrityError` exception
-        was raised, `True` if there were no exceptions (which means, `False` will be returned if there is
-        <b>anything</b> wrong with the request, e. g. the user with the `tg_operator_id` identifier is not an operator)
+    :return: If the conversation was started successfully, a tuple of two `int`s is returned: the local ids of the
+        client and of the operator. Otherwise (<b>for example</b>, if either the client or the operator is busy)
+        `(None, None)` is returned. Formally, `(None, None)` is returned if the `psycopg2.errors.IntegrityError`
+        exception was raised (which means, it will be returned if there is <b>anything</b> wrong with the request, e. g.
+        the user with the `tg_operator_id` identifier is not an operator)
     """
     with PrettyCursor() as cursor:
         try:
-            cursor.execute("INSERT INTO conversations(client_id, operator_id) VALUES (%s, %s)",
+            cursor.execute("WITH ins AS (INSERT INTO conversations(client_id, operator_id) VALUES (%s, %s) "
+                           "             RETURNING client_id, operator_id) "
+                           "SELECT uc.local_id, uo.local_id FROM ins "
+                           "JOIN users uc ON uc.tg_id=ins.client_id JOIN users uo ON uo.tg_id=ins.operator_id",
                            (tg_client_id, tg_operator_id))
         except psycopg2.errors.IntegrityError:  # Either this operator or this client is busy, or something else is bad
-            return False
-        else:
-            return True
+            return None, None
+        local_client_id, local_operator_id = cursor.fetchone()
+
+    invalidate_conversing_cache(tg_client_id, tg_operator_id)
+
+    return local_client_id, local_operator_id
 
-def end_conversation(tg_client_id: int) -> None:
+def end_conversation(tg_client_id: int) -> Union[Tuple[Tuple[int, int], Tuple[int, int]],
+                                                  Tuple[Tuple[None, None], Tuple[None, None]]]:
     """
     End the conversation between the client and an operator if there is any
 
@@ -86,12 +158,40 @@ def end_conversation(tg_client_id: int) -> None:
     implementation.
 
     :param tg_client_id: Telegram id of the client ending the conversation
+    :return: Description of the ended conversation in the same format as the one returned by `get_conversing`. If the
+        client was not in a conversation, `((None, None), (None, None))` is returned
     """
     with PrettyCursor() as cursor:
-        cursor.execute("DELETE FROM conversations WHERE client_id=%s", (tg_client_id,))
+        cursor.execute("WITH del AS (DELETE FROM conversations WHERE client_id=%s RETURNING client_id, operator_id) "
+                       "SELECT del.client_id, uc.local_id, del.operator_id, uo.local_id FROM del "
+                       "JOIN users uc ON uc.tg_id=del.client_id JOIN users uo ON uo.tg_id=del.operator_id",
+                       (tg_client_id,))
+        try:
+            a, b, c, d = cursor.fetchone()
+        except TypeError:
+            return (None, None), (None, None)
+
+    invalidate_conversing_cache(a, c)
+
+    return (a, b), (c, d)
+
+
+# Admins are not changed by the bot itself, so their ids are only re-read from the database once in a while.
+# `admins_ids_cache` is a tuple of the moment (by `time.monotonic`) when the cached ids expire and the ids themselves
+admins_ids_cache_ttl = 60
+admins_ids_cache = (float('-inf'), [])
 
 
 def get_admins_ids() -> List[int]:
+    global admins_ids_cache
+
+    expires, admins_ids = admins_ids_cache
+    if monotonic() < expires:
+        return list(admins_ids)
+
     with PrettyCursor() as cursor:
         cursor.execute("SELECT tg_id FROM users WHERE is_admin")
-        return [i[0] for i in cursor.fetchall()]
+        admins_ids = [i[0] for i in cursor.fetchall()]
+
+    admins_ids_cache = (monotonic() + admins_ids_cache_ttl, admins_ids)
+    return list(admins_ids)
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from functools import wraps
 from sys import stderr
@@ -5,17 +6,20 @@ from traceback import format_exc
 from threading import Lock
 
 import telebot
-from typing import Callable
+from typing import Any, Callable
 
-from db_connector import PrettyCursor
+from db_connector import PrettyCursor, reflected_message_lookup
 from logic import add_user, begin_conversation, end_conversation, get_conversing, get_admins_ids, get_free_operators, \
     get_local_id
 from config import bot_token
-from callback_helpers import contract_callback_data_and_jdump, jload_and_decontract_callback_data, \
-    seconds_since_local_epoch, datetime_from_local_epoch_secs
+from callback_helpers import pack_callback_data, unpack_callback_data, seconds_since_local_epoch, \
+    datetime_from_local_epoch_secs
 
 
-bot = telebot.TeleBot(bot_token)
+# Handlers are run by a pool of worker threads, so that a slow query or Telegram API call made for one user doesn't
+# stall the others. Each worker holds at most one database connection at a time, so there must be no more workers than
+# the maximum number of connections in `db_connector.connection_pool`
+bot = telebot.TeleBot(bot_token, num_threads=8)
 
 
 # Whenever a client requests a conversation, all the <b>free</b> operators get a message which invites them to start
@@ -48,8 +52,11 @@ def invite_operators(tg_client_id: int) -> int:
     keyboard = telebot.types.InlineKeyboardMarkup()
     callback_data = {'type': 'conversation_acceptation', 'client_id': tg_client_id}
     keyboard.add(telebot.types.InlineKeyboardButton("Присоединиться",
-                                                    callback_data=contract_callback_data_and_jdump(callback_data)))
-    local_client_id = get_local_id(tg_client_id)
+                                                    callback_data=pack_callback_data(callback_data)))
+    # The same invitation is sent to every operator, so it is rendered once rather than on each `send_message`
+    keyboard_json = keyboard.to_json()
+    invitation_text = f"Пользователь №{get_local_id(tg_client_id)} хочет побеседовать. Нажмите кнопку ниже, чтобы " \
+                      "стать его оператором"
 
     with conversation_starter_lock:
         if tg_client_id in operators_invitations_messages.keys():
@@ -63,9 +70,7 @@ def invite_operators(tg_client_id: int) -> int:
             try:
                 msg_ids.append((
                     tg_operator_id,
-                    bot.send_message(tg_operator_id, f"Пользователь №{local_client_id} хочет побеседовать. Нажмите "
-                                                     "кнопку ниже, чтобы стать его оператором",
-                                     reply_markup=keyboard).message_id
+                    bot.send_message(tg_operator_id, invitation_text, reply_markup=keyboard_json).message_id
                 ))
             except telebot.apihelper.ApiException:
                 print("Telegram API Exception while sending out operators invitations:", file=stderr)
@@ -95,6 +100,10 @@ def clear_invitation_messages(tg_client_id: int) -> bool:
             return False
 
 
+# `notification_executor` is used by `notify_admins` for sending messages to multiple admins concurrently
+notification_executor = ThreadPoolExecutor(max_workers=8)
+
+
 def notify_admins(**kwargs) -> bool:
     """
     Send a text message to all the bot administrators. Any exceptions occurring inside are suppressed
@@ -110,18 +119,21 @@ def notify_admins(**kwargs) -> bool:
         print(format_exc(), file=stderr)
         return False
 
+    def send_to_admin(admin_id: int) -> bool:
+        try:
+            bot.send_message(chat_id=admin_id, **kwargs)
+        except Exception:
+            print("Couldn't send a message to an admin inside of `notify_admins`:", file=stderr)
+            print(format_exc(), file=stderr)
+            return False
+        else:
+            return True
+
     sent = False
 
     try:
-        for i in admins:
-            try:
-                bot.send_message(chat_id=i, **kwargs)
-            except Exception:
-                print("Couldn't send a message to an admin inside of `notify_admins`:", file=stderr)
-                print(format_exc(), file=stderr)
-            else:
-                sent = True
-
+        # Messages are sent concurrently, so that the total delay is that of the slowest request, not the sum of all
+        sent = any(list(notification_executor.map(send_to_admin, admins)))
     except Exception:
         print("Something went wrong while **iterating** throw `admins` inside of `notify_admins`:", file=stderr)
         print(format_exc(), file=stderr)
@@ -129,26 +141,40 @@ def notify_admins(**kwargs) -> bool:
     return sent
 
 
-def nonfalling_handler(func: Callable):
+# Maximum length of a traceback included into a Telegram message
+max_sent_traceback_length = 3500
+
+
+def nonfalling_handler(func: Callable, get_chat_id: Callable[[Any], int]):
+    """
+    Wraps a handler so that any exception raised inside of it is reported to the admins and to the user instead of being
+    propagated
+
+    :param func: Handler to be wrapped
+    :param get_chat_id: Function which extracts the id of the chat to report an error to from the handler's first
+        argument
+    :return: The wrapped handler
+    """
     @wraps(func)
-    def ans(message: telebot.types.Message, *args, **kwargs):
+    def ans(update, *args, **kwargs):
         try:
-            func(message, *args, **kwargs)
+            func(update, *args, **kwargs)
         except Exception:
             try:
-                # For callback query handlers (we got a `telebot.types.CallbackQuery` object instead of a message)
-                if hasattr(message, 'message'):
-                    message = message.message
+                tb = format_exc()
+                # Telegram doesn't accept messages longer than 4096 characters, so only the end of the traceback (where
+                # the actual error is) is sent
+                short_tb = tb[-max_sent_traceback_length:]
 
                 s = "Произошла ошибка"
-                if notify_admins(text=('```' + format_exc() + '```'), parse_mode="Markdown"):
+                if notify_admins(text=('```' + short_tb + '```'), parse_mode="Markdown"):
                     s += ". Наши администраторы получили уведомление о ней"
                 else:
                     s += ". Свяжитесь с администрацией бота для исправления"
-                s += ". Технические детали:\n```" + format_exc() + "```"
+                s += ". Технические детали:\n```" + short_tb + "```"
 
-                print(format_exc(), file=stderr)
-                bot.send_message(message.chat.id, s, parse_mode="Markdown")
+                print(tb, file=stderr)
+                bot.send_message(get_chat_id(update), s, parse_mode="Markdown")
             except Exception:
                 print("An exception while handling an exception:", file=stderr)
                 print(format_exc(), file=stderr)
@@ -156,18 +182,35 @@ def nonfalling_handler(func: Callable):
     return ans
 
 
-class AnyContentType:
-    def __contains__(self, item): return True
+def nonfalling_message_handler(func: Callable):
+    """`nonfalling_handler` for handlers which accept a `telebot.types.Message`"""
+    return nonfalling_handler(func, lambda message: message.chat.id)
+
+def nonfalling_callback_handler(func: Callable):
+    """`nonfalling_handler` for handlers which accept a `telebot.types.CallbackQuery`"""
+    return nonfalling_handler(func, lambda call: call.message.chat.id)
+
+
+# All the content types which `telebot.types.Message` can have. `None` is the content type of messages of the kinds
+# unknown to `telebot`
+all_content_types = frozenset((
+    None,
+    'text', 'audio', 'animation', 'document', 'game', 'photo', 'sticker', 'video', 'video_note', 'voice', 'contact',
+    'location', 'venue', 'dice', 'new_chat_members', 'left_chat_member', 'new_chat_title', 'new_chat_photo',
+    'delete_chat_photo', 'group_chat_created', 'supergroup_chat_created', 'channel_chat_created', 'migrate_to_chat_id',
+    'migrate_from_chat_id', 'pinned_message', 'invoice', 'successful_payment', 'connected_website', 'poll',
+    'passport_data'
+))
 
 
 @bot.message_handler(commands=['start', 'help'])
-@nonfalling_handler
+@nonfalling_message_handler
 def start_help_handler(message: telebot.types.Message):
     bot.reply_to(message, "Привет. /request_conversation, чтобы начать беседу, /end_conversation чтобы завершить")
     add_user(message.chat.id)
 
 @bot.message_handler(commands=['request_conversation'])
-@nonfalling_handler
+@nonfalling_message_handler
 def request_conversation_handler(message: telebot.types.Message):
     (tg_client_id, _), (tg_operator_id, _) = get_conversing(message.chat.id)
     if tg_operator_id == message.chat.id:
@@ -190,44 +233,51 @@ def request_conversation_handler(message: telebot.types.Message):
             raise NotImplementedError("`invite_operators` returned an unexpected value")
 
 
+# Texts of the buttons for rating a conversation with the corresponding `mood` values of callback data
+conversation_rate_moods = (("Лучше", 'better'), ("Так же", 'same'), ("Хуже", 'worse'))
+
+
 @bot.message_handler(commands=['end_conversation'])
-@nonfalling_handler
+@nonfalling_message_handler
 def end_conversation_handler(message: telebot.types.Message):
-    (_, client_local), (operator_tg, operator_local) = get_conversing(message.chat.id)
+    (_, client_local), (operator_tg, operator_local) = end_conversation(message.chat.id)
 
     if operator_tg is None:
-        if clear_invitation_messages(message.chat.id):
+        (_, _), (operator_tg, _) = get_conversing(message.chat.id)
+        if operator_tg == message.chat.id:
+            bot.reply_to(message, "Оператор не может прекратить беседу. Обратитесь к @kolayne для реализации такой "
+                                  "возможности")
+        elif clear_invitation_messages(message.chat.id):
             bot.reply_to(message, "Ожидание операторов отменено. Используйте /request_conversation, чтобы запросить "
                                   "помощь снова")
         else:
             bot.reply_to(message, "В данный момент вы ни с кем не беседуете. Используйте /request_conversation, чтобы "
                                   "начать")
-    elif operator_tg == message.chat.id:
-        bot.reply_to(message, "Оператор не может прекратить беседу. Обратитесь к @kolayne для реализации такой "
-                              "возможности")
     else:
-        keyboard = telebot.types.InlineKeyboardMarkup()
-        d = {'type': 'conversation_rate', 'operator_ids': [operator_tg, operator_local],
-             'conversation_end_moment': seconds_since_local_epoch(datetime.now())}
-
-        keyboard.add(
-            telebot.types.InlineKeyboardButton("Лучше",
-                                               callback_data=contract_callback_data_and_jdump({**d, 'mood': 'better'})),
-            telebot.types.InlineKeyboardButton("Так же",
-                                               callback_data=contract_callback_data_and_jdump({**d, 'mood': 'same'})),
-            telebot.types.InlineKeyboardButton("Хуже",
-                                               callback_data=contract_callback_data_and_jdump({**d, 'mood': 'worse'}))
-        )
-        keyboard.add(telebot.types.InlineKeyboardButton("Не хочу оценивать",
-                                                        callback_data=contract_callback_data_and_jdump(d)))
+        try:
+            keyboard = telebot.types.InlineKeyboardMarkup()
+            d = {'type': 'conversation_rate', 'operator_tg_id': operator_tg, 'operator_local_id': operator_local,
+                 'conversation_end_moment': seconds_since_local_epoch(datetime.now())}
+
+            keyboard.add(*(
+                telebot.types.InlineKeyboardButton(text, callback_data=pack_callback_data({**d, 'mood': mood}))
+                for text, mood in conversation_rate_moods
+            ))
+            keyboard.add(telebot.types.InlineKeyboardButton("Не хочу оценивать", callback_data=pack_callback_data(d)))
+
+            bot.reply_to(message, "Беседа с оператором прекратилась. Хотите оценить свое самочувствие после нее? "
+                                  "Вы остаетесь анонимным", reply_markup=keyboard)
+        finally:
+            # The conversation has already been ended, so the operator must be notified even if the client couldn't be
+            bot.send_message(operator_tg, f"Пользователь №{client_local} прекратил беседу")
+
+# Types of message entities which are not lost when a message is reflected to the interlocutor (in addition to these,
+# URLs which are written in the text as is are not lost either)
+benign_entity_types = frozenset(('mention',))
 
-        end_conversation(message.chat.id)
-        bot.reply_to(message, "Беседа с оператором прекратилась. Хотите оценить свое самочувствие после нее? "
-                              "Вы остаетесь анонимным", reply_markup=keyboard)
-        bot.send_message(operator_tg, f"Пользователь №{client_local} прекратил беседу")
 
 @bot.message_handler(content_types=['text'])
-@nonfalling_handler
+@nonfalling_message_handler
 def text_message_handler(message: telebot.types.Message):
     (client_tg, _), (operator_tg, _) = get_conversing(message.chat.id)
 
@@ -241,8 +291,7 @@ def text_message_handler(message: telebot.types.Message):
     reply_to = None
     if message.reply_to_message is not None:
         with PrettyCursor() as cursor:
-            cursor.execute("SELECT sender_message_id FROM reflected_messages WHERE sender_chat_id=%s AND "
-                           "receiver_chat_id=%s AND receiver_message_id=%s",
+            cursor.execute(f"EXECUTE {reflected_message_lookup.name}(%s, %s, %s)",
                            (interlocutor_id, message.chat.id, message.reply_to_message.message_id))
             try:
                 reply_to, = cursor.fetchone()
@@ -250,53 +299,51 @@ def text_message_handler(message: telebot.types.Message):
                 bot.reply_to(message, "Эта беседа уже завершилась. Вы не можете ответить на это сообщение")
                 return
 
-    for entity in message.entities or []:
-        if entity.type == 'mention':
-            continue
-        if entity.type == 'url' and message.text[entity.offset: entity.offset + entity.length] == entity.url:
-            continue
-
+    text = message.text
+    if any(entity.type not in benign_entity_types and
+           not (entity.type == 'url' and text[entity.offset: entity.offset + entity.length] == entity.url)
+           for entity in message.entities or ()):
         bot.reply_to(message, "Это сообщение содержит форматирование, которое сейчас не поддерживается. Оно будет "
                               "отправлено с потерей форматирования. Мы работаем над этим")
-        break
 
-    sent = bot.send_message(interlocutor_id, message.text, reply_to_message_id=reply_to)
+    sent = bot.send_message(interlocutor_id, text, reply_to_message_id=reply_to)
 
     with PrettyCursor() as cursor:
-        query = "INSERT INTO reflected_messages(sender_chat_id, sender_message_id, receiver_chat_id, " \
-                "receiver_message_id) VALUES (%s, %s, %s, %s)"
-        cursor.execute(query, (message.chat.id, message.message_id, sent.chat.id, sent.message_id))
-        cursor.execute(query, (sent.chat.id, sent.message_id, message.chat.id, message.message_id))
+        # The mapping is stored in both directions, so that either interlocutor can reply to the message
+        cursor.execute("INSERT INTO reflected_messages(sender_chat_id, sender_message_id, receiver_chat_id, "
+                       "receiver_message_id) VALUES (%s, %s, %s, %s), (%s, %s, %s, %s)",
+                       (message.chat.id, message.message_id, sent.chat.id, sent.message_id,
+                        sent.chat.id, sent.message_id, message.chat.id, message.message_id))
 
 
-@bot.message_handler(content_types=AnyContentType())
-@nonfalling_handler
+@bot.message_handler(content_types=all_content_types)
+@nonfalling_message_handler
 def another_content_type_handler(message: telebot.types.Message):
     bot.reply_to(message, "Сообщения этого типа не поддерживаются. Свяжитесь с @kolayne, чтобы добавить поддержку")
 
 
 def get_type_from_callback_data(call_data):
-    d = jload_and_decontract_callback_data(call_data)
-    if not isinstance(d, dict):
+    d = unpack_callback_data(call_data)
+    if d is None:
         return None
-    return d.get('type')
+    return d['type']
 
 
 # Invalid callback query handler
 @bot.callback_query_handler(func=lambda call: get_type_from_callback_data(call.data) is None)
-@nonfalling_handler
+@nonfalling_callback_handler
 def invalid_callback_query(call: telebot.types.CallbackQuery):
     bot.answer_callback_query(call.id, "Действие не поддерживается или некорректные данные обратного вызова")
 
 
 @bot.callback_query_handler(func=lambda call: get_type_from_callback_data(call.data) == 'conversation_rate')
-@nonfalling_handler
+@nonfalling_callback_handler
 def conversation_rate_callback_query(call: telebot.types.CallbackQuery):
-    d = jload_and_decontract_callback_data(call.data)
+    d = unpack_callback_data(call.data)
 
     mood = d.get('mood')
     if mood == 'worse':
-        operator_tg, operator_local = d['operator_ids']
+        operator_tg, operator_local = d['operator_tg_id'], d['operator_local_id']
         conversation_end = datetime_from_local_epoch_secs(d['conversation_end_moment'])
         notification_text = "Клиент чувствует себя хуже после беседы с оператором {}, которая завершилась в {}".format(
             f"[{operator_local}](tg://user?id={operator_tg})", conversation_end
@@ -312,20 +359,19 @@ def conversation_rate_callback_query(call: telebot.types.CallbackQuery):
 
 
 @bot.callback_query_handler(func=lambda call: get_type_from_callback_data(call.data) == 'conversation_acceptation')
-@nonfalling_handler
+@nonfalling_callback_handler
 def conversation_acceptation_callback_query(call: telebot.types.CallbackQuery):
-    d = jload_and_decontract_callback_data(call.data)
+    d = unpack_callback_data(call.data)
     with conversation_starter_lock:
         if call.message.chat.id in operators_invitations_messages.keys():
             bot.answer_callback_query(call.id, "Невозможно начать беседу, пока вы ожидаете оператора")
             return
 
-        conversation_began = begin_conversation(d['client_id'], call.message.chat.id)
+        local_client_id, local_operator_id = begin_conversation(d['client_id'], call.message.chat.id)
 
-    if conversation_began:
+    if local_client_id is not None:
         clear_invitation_messages(d['client_id'])
 
-        (_, local_client_id), (_, local_operator_id) = get_conversing(call.message.chat.id)
         bot.answer_callback_query(call.id)
         bot.send_message(call.message.chat.id, f"Началась беседа с клиентом №{local_client_id}. Отправьте "
                                                "сообщение, и собеседник его увидит")